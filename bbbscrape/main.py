@@ -3,19 +3,21 @@
 # SPDX-License-Identifier: MIT
 
 import argparse
-import copy
+import asyncio
+import bisect
 import os
+import shutil
 import subprocess
+import threading
 from urllib.parse import parse_qs, urlparse
 from collections import namedtuple
-from queue import Queue
-from threading import Thread
-from xml.etree import ElementTree
+from concurrent.futures import ThreadPoolExecutor
+from lxml import etree as ElementTree
 
+import aiohttp
+import cairosvg
 import requests
-
-namespaces = {"svg": "http://www.w3.org/2000/svg",
-              "xlink": "http://www.w3.org/1999/xlink"}
+from requests.adapters import HTTPAdapter, Retry
 
 Image = namedtuple("Image", ["id", "fname", "ts_in", "ts_out"])
 Frame = namedtuple("Frame", ["fname", "ts_in", "ts_out"])
@@ -26,6 +28,13 @@ class Scrape:
         self.host = host
         self.baseurl = "https://{}/presentation/{}".format(host, id)
         self.id = id
+        # One session for all fetches: keep-alive amortizes the TCP/TLS
+        # handshake over every image download to the same host.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32,
+                              max_retries=Retry(total=3, backoff_factor=0.2))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
 
     def create_output_dir(self):
         self.out = "bbb-scrape-{}".format(self.id)
@@ -36,77 +45,129 @@ class Scrape:
 
     def fetch_shapes(self):
         url = "{}/shapes.svg".format(self.baseurl)
-        shapes = requests.get(url)
-        self.shapes = ElementTree.fromstring(shapes.content)
-        open(os.path.join(self.out, "shapes.svg"), "wb").write(shapes.content)
+        # Feed the response body straight into the parser so parsing
+        # overlaps with the download and the raw bytes are never held in
+        # memory; the (href-rewritten) tree is written out by
+        # fetch_images once the downloads are done.
+        with self.session.get(url, stream=True) as req:
+            req.raw.decode_content = True
+            self._parse_shapes(req.raw)
+
+    def _parse_shapes(self, source):
+        self._timestamps = set()
+        self._image_elems = []
+        self._canvas_by_image = {}
+        context = ElementTree.iterparse(source, events=("end",),
+                                        huge_tree=True,
+                                        remove_blank_text=True,
+                                        collect_ids=False)
+        for event, e in context:
+            for key in ("in", "out", "timestamp"):
+                value = e.attrib.get(key)
+                if value is not None:
+                    self._timestamps.add(float(value))
+            if e.tag == "{http://www.w3.org/2000/svg}image":
+                self._image_elems.append(e)
+            if e.attrib.get("class") == "canvas":
+                self._canvas_by_image[e.attrib["image"]] = e
+        self.shapes = context.root
+
+    def _fetch_video(self, url, fname):
+        # Stream to disk instead of buffering the whole MP4 in memory;
+        # copyfileobj reads from the raw socket into the file buffer
+        # without assembling intermediate chunk objects.
+        with self.session.get(url, stream=True) as req:
+            if req.status_code != 200:
+                return False
+            # As in fetch_shapes: the raw stream bypasses requests'
+            # transparent decoding, so undo any Content-Encoding here.
+            req.raw.decode_content = True
+            with open(os.path.join(self.out, fname), "wb") as f:
+                shutil.copyfileobj(req.raw, f, length=1 << 20)
+        return True
 
     def fetch_deskshare(self):
         url = "{}/deskshare/deskshare.mp4".format(self.baseurl)
-        req = requests.get(url)
-        if req.status_code == 200:
-            fname = os.path.join(self.out, "deskshare.mp4")
-            open(fname, "wb").write(req.content)
-            return True
-        return False
+        return self._fetch_video(url, "deskshare.mp4")
 
     def fetch_webcams(self):
         url = "{}/video/webcams.mp4".format(self.baseurl)
-        req = requests.get(url)
-        if req.status_code == 200:
-            fname = os.path.join(self.out, "webcams.mp4")
-            open(fname, "wb").write(req.content)
-            return True
-        return False
-
-    def fetch_image(self):
-        while True:
-            e = self.workq.get()
-            href = e.attrib["{http://www.w3.org/1999/xlink}href"]
-            fname = os.path.basename(href)
-            url = "{}/{}".format(self.baseurl, href)
-            image = requests.get(url)
-            open(os.path.join(self.out, fname), "wb").write(image.content)
-            e.attrib["{http://www.w3.org/1999/xlink}href"] = fname
-            if "id" in e.attrib:
-                self.images.append(Image(id=e.attrib["id"],
-                                         fname=fname,
-                                         ts_in=float(e.attrib["in"]),
-                                         ts_out=float(e.attrib["out"])))
-            self.workq.task_done()
-
-    def fetch_images(self, tree=None):
-        if tree is None:
-            self.images = []
-            self.workq = Queue()
-            for i in range(os.cpu_count()):
-                Thread(target=Scrape.fetch_image, args=(self,)).start()
-            self.fetch_images(self.shapes)
-            fname = os.path.join(self.out, "shapes.svg")
-            open(fname, "wb").write(ElementTree.tostring(self.shapes))
-            self.workq.join()
-            return
-
-        for e in tree.findall("svg:image", namespaces):
-            self.workq.put(e)
-        for e in tree:
-            self.fetch_images(e)
-
-    def read_timestamps(self, tree=None):
-        if tree is None:
-            self.timestamps = []
-            self.read_timestamps(self.shapes)
-            self.timestamps = list(dict.fromkeys(self.timestamps))
-            self.timestamps.sort()
-            return
-
-        for e in tree:
-            if "in" in e.attrib:
-                self.timestamps.append(float(e.attrib["in"]))
-            if "out" in e.attrib:
-                self.timestamps.append(float(e.attrib["out"]))
-            if "timestamp" in e.attrib:
-                self.timestamps.append(float(e.attrib["timestamp"]))
-            self.read_timestamps(e)
+        return self._fetch_video(url, "webcams.mp4")
+
+    async def _fetch_one_image(self, session, semaphore, e):
+        href = e.attrib["{http://www.w3.org/1999/xlink}href"]
+        fname = os.path.basename(href)
+        url = "{}/{}".format(self.baseurl, href)
+        async with semaphore:
+            async with session.get(url) as resp:
+                resp.raise_for_status()
+                data = await resp.read()
+        with open(os.path.join(self.out, fname), "wb") as f:
+            f.write(data)
+        e.attrib["{http://www.w3.org/1999/xlink}href"] = fname
+        if "id" in e.attrib:
+            self.images.append(Image(id=e.attrib["id"],
+                                     fname=fname,
+                                     ts_in=float(e.attrib["in"]),
+                                     ts_out=float(e.attrib["out"])))
+
+    async def _fetch_images_async(self):
+        # Coroutines instead of one blocked thread per request: many
+        # downloads in flight on a single thread, bounded by the
+        # semaphore rather than the pool size.
+        semaphore = asyncio.Semaphore(32)
+        connector = aiohttp.TCPConnector(limit=64)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            await asyncio.gather(*(self._fetch_one_image(session, semaphore, e)
+                                   for e in self._image_elems))
+
+    def fetch_images(self):
+        self.images = []
+        asyncio.run(self._fetch_images_async())
+        fname = os.path.join(self.out, "shapes.svg")
+        with open(fname, "wb") as f:
+            f.write(ElementTree.tostring(self.shapes))
+        # Keyed for binary search of the active image in generate_frame.
+        self.images.sort(key=lambda i: i.ts_in)
+        self._image_ts_in = [i.ts_in for i in self.images]
+
+    def read_timestamps(self):
+        self.timestamps = sorted(self._timestamps)
+
+        # Pre-serialize everything a frame can be assembled from: the
+        # <svg> open tag, one <image> blob per slide, and per canvas the
+        # <g> open tag plus its children in timestamp order with the
+        # visibility:hidden toggle already stripped. generate_frame then
+        # only concatenates blobs.
+        nsmap = self.shapes.nsmap
+        root = ElementTree.Element(self.shapes.tag, self.shapes.attrib,
+                                   nsmap=nsmap)
+        self.svg_header = ElementTree.tostring(root)[:-2] + b">"
+        self.image_blobs = {}
+        for e in self._image_elems:
+            if "id" not in e.attrib:
+                continue
+            img = ElementTree.Element(e.tag, e.attrib, nsmap=nsmap)
+            img.attrib["style"] = ""
+            # The frame SVGs live in frames/ while _fetch_one_image saves
+            # the slides one level up; cairosvg resolves relative hrefs
+            # against the SVG's own directory.
+            img.attrib["{http://www.w3.org/1999/xlink}href"] = \
+                "../" + e.attrib["{http://www.w3.org/1999/xlink}href"]
+            self.image_blobs[e.attrib["id"]] = ElementTree.tostring(img)
+        self.canvas_blobs = {}
+        for image, canvas in self._canvas_by_image.items():
+            g = ElementTree.Element(canvas.tag, canvas.attrib, nsmap=nsmap)
+            g.attrib["display"] = "inherit"
+            open_tag = ElementTree.tostring(g)[:-2] + b">"
+            # Children without a timestamp (and comment nodes) were never
+            # shown by make_visible; skip them here as well.
+            children = sorted((c for c in canvas if "timestamp" in c.attrib),
+                              key=lambda c: float(c.attrib["timestamp"]))
+            blobs = [ElementTree.tostring(c).replace(b"visibility:hidden", b"")
+                     for c in children]
+            ts_list = [float(c.attrib["timestamp"]) for c in children]
+            self.canvas_blobs[image] = (open_tag, blobs, ts_list)
 
     def generate_frames(self):
         try:
@@ -114,66 +175,96 @@ class Scrape:
         except FileExistsError:
             pass
         self.frames = []
+        self._rendered = {}
+        self._rendered_lock = threading.Lock()
 
-        self.workq = Queue()
-        for i in range(os.cpu_count()):
-            Thread(target=Scrape.generate_frame, args=(self,)).start()
-
-        t = 0.0
-        for ts in self.timestamps[1:]:
-            self.workq.put((t, ts))
-            t = ts
-        self.workq.join()
-
-    def generate_frame(self):
-        while True:
-            (timestamp, ts_out) = self.workq.get()
-            shapes = copy.deepcopy(self.shapes)
-            image = None
-            for i in self.images:
-                if timestamp >= i.ts_in and timestamp < i.ts_out:
-                    image = i.id
-            for e in shapes.findall("svg:image", namespaces):
-                if e.attrib["id"] == image:
-                    e.attrib["style"] = ""
-                else:
-                    shapes.remove(e)
-            for e in shapes.findall("svg:g", namespaces):
-                assert(e.attrib["class"] == "canvas")
-                if e.attrib["image"] == image:
-                    e.attrib["display"] = "inherit"
-                    self.make_visible(e, timestamp)
-                else:
-                    shapes.remove(e)
-            fname = os.path.join("frames", "shapes{}.png".format(timestamp))
-            fnamesvg = os.path.join("frames", "shapes{}.svg".format(timestamp))
-            shapestr = ElementTree.tostring(shapes)
-            open(os.path.join(self.out, fnamesvg), "wb").write(shapestr)
-            subprocess.run(["inkscape", "--export-png={}".format(fname),
-                            "--export-area-drawing", fnamesvg],
-                           cwd=self.out, stdout=subprocess.PIPE,
-                           stderr=subprocess.PIPE)
-            frame = Frame(fname=fname, ts_in=timestamp, ts_out=ts_out)
-            self.frames.append(frame)
-            self.workq.task_done()
-
-    def make_visible(self, tree, timestamp):
-        for e in tree.findall("svg:g", namespaces):
-            if ("timestamp" in e.attrib and
-               float(e.attrib["timestamp"]) <= timestamp):
-                style = e.attrib["style"].split(";")
-                style.remove("visibility:hidden")
-                e.attrib["style"] = ";".join(style)
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+            futures = []
+            t = 0.0
+            for ts in self.timestamps[1:]:
+                futures.append(ex.submit(self.generate_frame, t, ts))
+                t = ts
+            for future in futures:
+                future.result()
+        # Workers append in completion order; restore temporal order so
+        # concat.txt plays back correctly and ffmpeg reads the PNGs
+        # sequentially.
+        self.frames.sort(key=lambda f: f.ts_in)
+
+    def generate_frame(self, timestamp, ts_out):
+        image = None
+        idx = bisect.bisect_right(self._image_ts_in, timestamp) - 1
+        if idx >= 0 and timestamp < self.images[idx].ts_out:
+            image = self.images[idx].id
+        n_visible = 0
+        if image in self.canvas_blobs:
+            n_visible = bisect.bisect_right(self.canvas_blobs[image][2],
+                                            timestamp)
+        fname = os.path.join("frames", "shapes{}.png".format(timestamp))
+        fnamesvg = os.path.join("frames", "shapes{}.svg".format(timestamp))
+        # A frame is fully determined by the active image and how many of
+        # its (timestamp-sorted) strokes are visible; hard-link the PNG
+        # of the first render instead of rasterizing again.
+        key = (image, n_visible)
+        with self._rendered_lock:
+            entry = self._rendered.get(key)
+            if entry is None:
+                # [png fname, render-done event, render error if any]
+                entry = [fname, threading.Event(), None]
+                self._rendered[key] = entry
+                first = True
             else:
-                tree.remove(e)
+                first = False
+        if first:
+            # Concatenate the pre-serialized blobs: no tree is built and
+            # no element is copied on the per-frame path.
+            try:
+                svgpath = os.path.join(self.out, fnamesvg)
+                with open(svgpath, "wb") as f:
+                    f.write(self.svg_header)
+                    if image is not None:
+                        f.write(self.image_blobs[image])
+                    if image in self.canvas_blobs:
+                        open_tag, blobs, _ = self.canvas_blobs[image]
+                        f.write(open_tag)
+                        f.writelines(blobs[:n_visible])
+                        f.write(b"</g>")
+                    f.write(b"</svg>")
+                cairosvg.svg2png(url=svgpath,
+                                 write_to=os.path.join(self.out, fname))
+            except BaseException as exc:
+                entry[2] = exc
+                raise
+            finally:
+                # Always wake the waiters, even on failure, so the pool
+                # can shut down and the exception reaches the caller.
+                entry[1].set()
+        else:
+            existing, done, _ = entry
+            done.wait()
+            if entry[2] is not None:
+                raise entry[2]
+            src = os.path.join(self.out, existing)
+            dst = os.path.join(self.out, fname)
+            # A previous run may have left the PNG behind; re-running
+            # into an existing output directory is supported everywhere
+            # else, so overwrite like the other writers do.
+            try:
+                os.link(src, dst)
+            except FileExistsError:
+                os.remove(dst)
+                os.link(src, dst)
+        frame = Frame(fname=fname, ts_in=timestamp, ts_out=ts_out)
+        self.frames.append(frame)
 
     def generate_concat(self):
-        f = open(os.path.join(self.out, "concat.txt"), "w")
+        lines = []
         for frame in self.frames:
-            f.write("file '{}'\n".format(frame.fname))
-            f.write("duration {:f}\n".format(frame.ts_out-frame.ts_in))
-        f.write("file '{}'\n".format(self.frames[-1].fname))
-        f.close()
+            lines.append("file '{}'\n".format(frame.fname))
+            lines.append("duration {:f}\n".format(frame.ts_out-frame.ts_in))
+        lines.append("file '{}'\n".format(self.frames[-1].fname))
+        with open(os.path.join(self.out, "concat.txt"), "w") as f:
+            f.write("".join(lines))
 
     def render_slides(self):
         subprocess.run(["ffmpeg", "-f", "concat", "-i", "concat.txt",
@@ -221,24 +312,23 @@ def main():
               " available in your PATH.")
         return 1
 
-    try:
-        subprocess.run(["inkscape", "--help"],
-                       stderr=subprocess.DEVNULL,
-                       stdout=subprocess.DEVNULL)
-    except OSError:
-        print("!! inkscape not found. Please install it and make sure it is"
-              "available in your PATH.")
-        return 1
-
     scrape = Scrape(host, meeting_id)
     print("++ Scrape from server")
     scrape.create_output_dir()
-    scrape.fetch_shapes()
-    scrape.fetch_images()
-    if not args.no_webcam and scrape.fetch_webcams():
-        print("++ Stored webcams to webcams.mp4")
-    if not args.no_deskshare and scrape.fetch_deskshare():
-        print("++ Stored desk sharing to deskshare.mp4")
+    # The videos do not depend on shapes.svg, so download them while the
+    # shapes are parsed and the slide images fetched; only fetch_images
+    # has to wait for fetch_shapes.
+    with ThreadPoolExecutor(max_workers=3) as ex:
+        shapes = ex.submit(scrape.fetch_shapes)
+        webcams = None if args.no_webcam else ex.submit(scrape.fetch_webcams)
+        deskshare = None if args.no_deskshare \
+            else ex.submit(scrape.fetch_deskshare)
+        shapes.result()
+        scrape.fetch_images()
+        if webcams is not None and webcams.result():
+            print("++ Stored webcams to webcams.mp4")
+        if deskshare is not None and deskshare.result():
+            print("++ Stored desk sharing to deskshare.mp4")
     print("++ Generate frames")
     scrape.read_timestamps()
     scrape.generate_frames()
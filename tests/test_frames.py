@@ -0,0 +1,105 @@
+# SPDX-License-Identifier: MIT
+
+"""Offline smoke test for the frame assembly + render path."""
+
+import io
+import os
+import sys
+import types
+
+from lxml import etree
+
+try:
+    import cairosvg  # noqa: F401
+except Exception:  # libcairo is not required for these tests
+    sys.modules["cairosvg"] = types.ModuleType("cairosvg")
+    sys.modules["cairosvg"].svg2png = None
+
+from bbbscrape.main import Image, Scrape
+
+XLINK_HREF = "{http://www.w3.org/1999/xlink}href"
+SVG_IMAGE = "{http://www.w3.org/2000/svg}image"
+
+SHAPES = b'''<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" width="800" height="600">
+  <image id="image1" in="0.0" out="10.0" xlink:href="presentation/abc/slide-1.png" width="800" height="600" style="visibility:hidden"/>
+  <image id="image2" in="10.0" out="20.0" xlink:href="presentation/abc/slide-2.png" width="800" height="600" style="visibility:hidden"/>
+  <g class="canvas" id="canvas1" image="image1" display="none">
+    <g timestamp="2.0" style="stroke:red;visibility:hidden"><path d="M0 0 L1 1"/></g>
+    <g timestamp="5.0" style="visibility:hidden;stroke:blue"><path d="M1 1 L2 2"/></g>
+    <g style="stroke:black"><path d="M9 9 L8 8"/></g>
+  </g>
+  <g class="canvas" id="canvas2" image="image2" display="none">
+    <g timestamp="12.0" style="stroke:green;visibility:hidden"><text>hi</text></g>
+  </g>
+  <g in="3.0" out="7.0"/>
+</svg>'''
+
+
+def make_scrape(tmp_path):
+    """Build a Scrape over tmp_path as fetch_shapes/fetch_images would,
+    with the slide PNGs saved next to shapes.svg but no network."""
+    scrape = Scrape("example.com", "abc")
+    scrape.out = str(tmp_path)
+    scrape._parse_shapes(io.BytesIO(SHAPES))
+    scrape.images = []
+    for e in scrape._image_elems:
+        fname = os.path.basename(e.attrib[XLINK_HREF])
+        e.attrib[XLINK_HREF] = fname
+        with open(os.path.join(scrape.out, fname), "wb") as f:
+            f.write(b"PNG")
+        scrape.images.append(Image(id=e.attrib["id"], fname=fname,
+                                   ts_in=float(e.attrib["in"]),
+                                   ts_out=float(e.attrib["out"])))
+    scrape.images.sort(key=lambda i: i.ts_in)
+    scrape._image_ts_in = [i.ts_in for i in scrape.images]
+    scrape.read_timestamps()
+    return scrape
+
+
+def install_render_stub(monkeypatch):
+    """Replace svg2png with a fake that resolves image hrefs the way
+    cairosvg does -- against the SVG document's directory -- and fails
+    if the referenced slide is missing."""
+    rendered = []
+
+    def svg2png(url=None, write_to=None, **kwargs):
+        tree = etree.parse(url)
+        base = os.path.dirname(url)
+        for image in tree.iter(SVG_IMAGE):
+            target = os.path.normpath(
+                os.path.join(base, image.attrib[XLINK_HREF]))
+            assert os.path.exists(target), \
+                "frame references missing slide: {}".format(target)
+        with open(write_to, "wb") as f:
+            f.write(b"PNG")
+        rendered.append(url)
+
+    monkeypatch.setattr("bbbscrape.main.cairosvg.svg2png", svg2png)
+    return rendered
+
+
+def test_frames_render_and_resolve_slides(tmp_path, monkeypatch):
+    scrape = make_scrape(tmp_path)
+    rendered = install_render_stub(monkeypatch)
+    scrape.generate_frames()
+    scrape.generate_concat()
+
+    # every frame got a PNG and the list is in temporal order
+    assert [f.ts_in for f in scrape.frames] == \
+        sorted(f.ts_in for f in scrape.frames)
+    for frame in scrape.frames:
+        assert os.path.exists(os.path.join(scrape.out, frame.fname))
+    # deduplication kicked in: fewer renders than frames
+    assert 0 < len(rendered) < len(scrape.frames)
+
+    # the rendered SVGs show the strokes visible at their timestamp
+    frame5 = etree.parse(os.path.join(scrape.out, "frames", "shapes5.0.svg"))
+    styles = [g.attrib["style"] for g in frame5.getroot()[1]]
+    assert styles == ["stroke:red;", ";stroke:blue"]
+
+
+def test_canvas_children_without_timestamp_are_skipped(tmp_path):
+    scrape = make_scrape(tmp_path)
+    _, blobs, ts_list = scrape.canvas_blobs["image1"]
+    assert ts_list == [2.0, 5.0]
+    assert not any(b"stroke:black" in blob for blob in blobs)